@@ -1,5 +1,6 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
 
 from trytond.model import fields
@@ -9,6 +10,25 @@ from trytond.transaction import Transaction
 
 __all__ = ['StockMove', 'Sale', 'SaleLine', 'Move', 'MoveLine']
 _ZERO = Decimal('0.0')
+_POSTED_STATES = {'posted', 'paid'}
+
+
+def _compute_qty(from_uom, qty, to_uom, rates=None):
+    """
+    Convert quantity like Uom.compute_qty but caching the conversion rate
+    of each pair of units of the same category in the supplied rates
+    dictionary (if any)
+    """
+    pool = Pool()
+    Uom = pool.get('product.uom')
+
+    if (rates is None or not qty or from_uom is None or to_uom is None
+            or from_uom.category != to_uom.category):
+        return Uom.compute_qty(from_uom, qty, to_uom)
+    key = (from_uom.id, to_uom.id)
+    if key not in rates:
+        rates[key] = Uom.compute_qty(from_uom, 1.0, to_uom, round=False)
+    return to_uom.round(qty * rates[key])
 
 
 # TODO: put it in account_invoice_stock
@@ -19,25 +39,66 @@ class StockMove:
     @property
     def posted_quantity(self):
         'The quantity from linked invoice lines in move unit and by invoice'
+        return self._read_stock_moves([self])[self.id]['posted_quantity']
+
+    @classmethod
+    def _read_stock_moves(cls, moves, uom_rates=None):
+        """
+        Return by move id the state, quantity and unit of the moves and the
+        quantity from linked and posted invoice lines in move unit by invoice
+
+        uom_rates is a dictionary to cache the unit conversion rates.
+        """
         pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
         Uom = pool.get('product.uom')
-        quantity = 0.0
-        invoice_quantity = {}
-        for invoice_line in self.invoice_lines:
-            if (invoice_line.invoice and
-                    invoice_line.invoice.state in ('posted', 'paid')):
-                if invoice_line.invoice.id not in invoice_quantity:
-                    invoice_quantity[invoice_line.invoice.id] = 0.0
-                quantity = Uom.compute_qty(invoice_line.unit,
-                    invoice_line.quantity, self.uom)
-                invoice_quantity[invoice_line.invoice.id] += quantity
-        return invoice_quantity
+
+        stock_moves = cls.read([m.id for m in moves],
+            ['state', 'quantity', 'uom', 'invoice_lines'])
+        invoice_lines = InvoiceLine.read(
+            [il for m in stock_moves for il in m['invoice_lines']],
+            ['invoice', 'unit', 'quantity'])
+        invoice_lines = dict((l['id'], l) for l in invoice_lines)
+        invoices = Invoice.browse(list(set(l['invoice']
+                    for l in invoice_lines.values() if l['invoice'])))
+        posted_invoices = set(i.id for i in invoices
+            if i.state in _POSTED_STATES)
+        units = dict((u.id, u) for u in Uom.browse(
+                    list(set(l['unit'] for l in invoice_lines.values()
+                            if l['unit'])
+                        | set(m['uom'] for m in stock_moves))))
+
+        res = {}
+        for values in stock_moves:
+            uom = units[values['uom']]
+            posted_quantity = defaultdict(float)
+            for invoice_line_id in values['invoice_lines']:
+                invoice_line = invoice_lines[invoice_line_id]
+                invoice = invoice_line['invoice']
+                if invoice not in posted_invoices:
+                    continue
+                posted_quantity[invoice] += _compute_qty(
+                    units.get(invoice_line['unit']),
+                    invoice_line['quantity'], uom, rates=uom_rates)
+            res[values['id']] = {
+                'state': values['state'],
+                'quantity': values['quantity'],
+                'uom': uom,
+                'posted_quantity': dict(posted_quantity),
+                }
+        return res
 
 
 class Move:
     __metaclass__ = PoolMeta
     __name__ = 'account.move'
 
+    @classmethod
+    def __setup__(cls):
+        super(Move, cls).__setup__()
+        cls.origin.select = True
+
     @classmethod
     def _get_origin(cls):
         origins = super(Move, cls)._get_origin()
@@ -49,7 +110,7 @@ class Move:
 class MoveLine:
     __metaclass__ = PoolMeta
     __name__ = 'account.move.line'
-    sale_line = fields.Many2One('sale.line', 'Sale Line')
+    sale_line = fields.Many2One('sale.line', 'Sale Line', select=True)
 
 
 class Sale:
@@ -68,72 +129,177 @@ class Sale:
     @classmethod
     def process(cls, sales):
         super(Sale, cls).process(sales)
-        for sale in sales:
-            sale.create_stock_account_move()
+        cls.create_stock_account_moves(sales)
 
     def create_stock_account_move(self):
         """
         Create, post and reconcile an account_move (if it is required to do)
         with lines related to Pending Invoices accounts.
         """
+        self.create_stock_account_moves([self])
+
+    @classmethod
+    def create_stock_account_moves(cls, sales):
+        """
+        Create, post and reconcile the account moves (if it is required to do)
+        of the sales with lines related to Pending Invoices accounts.
+        """
         pool = Pool()
         Config = pool.get('sale.configuration')
+        Date = pool.get('ir.date')
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
 
-        if self.invoice_method != 'shipment':
+        sales = [s for s in sales if s.invoice_method == 'shipment']
+        if not sales:
             return
 
         config = Config(1)
-        if not config.pending_invoice_account:
-            self.raise_user_error('no_pending_invoice_account')
+        pending_invoice_account = config.pending_invoice_account
+        if not pending_invoice_account:
+            cls.raise_user_error('no_pending_invoice_account')
+        accounting_date = Date.today()
+        journals = {}
+        periods = {}
+        uom_rates = {}
 
         with Transaction().set_context(_check_access=False):
-            account_move = self._get_stock_account_move(
-                config.pending_invoice_account)
-            if account_move:
-                account_move.save()
-                Move.post([account_move])
-
-                to_reconcile = MoveLine.search([
-                            ('move.origin', '=', str(self)),
-                            ('account', '=', config.pending_invoice_account),
-                            ('reconciliation', '=', None),
-                            ['OR',
-                                # previous pending line
-                                ('move', '!=', account_move),
-                                # current move "to reconcile line"
-                                ('sale_line', '=', None),
-                                ],
-                            ])
-                credit = sum(l.credit for l in to_reconcile)
-                debit = sum(l.debit for l in to_reconcile)
-                if to_reconcile and credit == debit:
-                    MoveLine.reconcile(to_reconcile)
-
-    def _get_stock_account_move(self, pending_invoice_account):
-        "Return the account move for shipped quantities"
+            account_moves = []
+            for sale in sales:
+                account_move = sale._get_stock_account_move(
+                    pending_invoice_account, accounting_date=accounting_date,
+                    journals=journals, periods=periods, uom_rates=uom_rates)
+                if account_move:
+                    account_moves.append(account_move)
+            if not account_moves:
+                return
+            cls._save_stock_account_moves(account_moves)
+            Move.post(account_moves)
+
+            move_ids = [m.id for m in account_moves]
+            lines = MoveLine.search([
+                        ('move.origin', 'in',
+                            [str(m.origin) for m in account_moves]),
+                        ('account', '=', pending_invoice_account.id),
+                        ('reconciliation', '=', None),
+                        ['OR',
+                            # previous pending line
+                            ('move', 'not in', move_ids),
+                            # current move "to reconcile line"
+                            ('sale_line', '=', None),
+                            ],
+                        ])
+            lines_by_sale = defaultdict(list)
+            for line in lines:
+                lines_by_sale[line.move.origin].append(line)
+
+            to_reconcile = []
+            for lines in lines_by_sale.values():
+                credit = debit = _ZERO
+                for line in lines:
+                    credit += line.credit
+                    debit += line.debit
+                if credit == debit:
+                    to_reconcile.append(lines)
+            # reconcile only accepts a single group of lines
+            for lines in to_reconcile:
+                MoveLine.reconcile(lines)
+
+    @classmethod
+    def _save_stock_account_moves(cls, account_moves):
+        """
+        Save the account moves and then create the analytic lines of all
+        their lines at once
+        """
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        # analytic lines by sale line and account of each move line, as there
+        # is only one revenue line of each sale line in a move
+        analytic_lines = []
+        for account_move in account_moves:
+            move_analytic_lines = {}
+            for line in account_move.lines:
+                if getattr(line, 'analytic_lines', None):
+                    key = (line.sale_line.id, line.account.id)
+                    move_analytic_lines[key] = list(line.analytic_lines)
+                    line.analytic_lines = []
+            analytic_lines.append(move_analytic_lines)
+
+        Move.save(account_moves)
+
+        to_save = []
+        for account_move, move_analytic_lines in zip(account_moves,
+                analytic_lines):
+            if not move_analytic_lines:
+                continue
+            for line in account_move.lines:
+                key = (line.sale_line.id if line.sale_line else None,
+                    line.account.id)
+                for analytic_line in move_analytic_lines.get(key, []):
+                    analytic_line.move_line = line
+                    to_save.append(analytic_line)
+        if to_save:
+            AnalyticLine = pool.get('analytic_account.line')
+            AnalyticLine.save(to_save)
+
+    def _get_stock_account_move(self, pending_invoice_account,
+            accounting_date=None, journals=None, periods=None,
+            uom_rates=None):
+        """
+        Return the account move for shipped quantities
+
+        journals and periods are dictionaries by company id shared by the
+        processed sales.
+        """
         pool = Pool()
         Date = pool.get('ir.date')
         Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
         Period = pool.get('account.period')
+        StockMove = pool.get('stock.move')
 
         if self.invoice_method in ['manual', 'order']:
             return
 
+        if accounting_date is None:
+            accounting_date = Date.today()
+        if journals is None:
+            journals = {}
+        if self.company.id not in journals:
+            journals[self.company.id] = self._get_accounting_journal()
+        journal = journals[self.company.id]
+
+        stock_moves = StockMove._read_stock_moves(
+            [m for l in self.lines for m in l.moves], uom_rates=uom_rates)
+        # Previously created stock account move lines (pending to invoice
+        # amount)
+        lines_to_reconcile = defaultdict(list)
+        for move_line in MoveLine.search([
+                    ('sale_line', 'in', [l.id for l in self.lines]),
+                    ('account', '=', pending_invoice_account.id),
+                    ('reconciliation', '=', None),
+                    ]):
+            lines_to_reconcile[move_line.sale_line.id].append(move_line)
         move_lines = []
         for line in self.lines:
             move_lines += line._get_stock_account_move_lines(
-                pending_invoice_account)
+                pending_invoice_account, stock_moves=stock_moves,
+                lines_to_reconcile=lines_to_reconcile[line.id],
+                accounting_date=accounting_date, journal=journal,
+                uom_rates=uom_rates)
         if not move_lines:
             return
 
-        accounting_date = Date().today()
-        period_id = Period.find(self.company.id, date=accounting_date)
+        if periods is None:
+            periods = {}
+        if self.company.id not in periods:
+            periods[self.company.id] = Period.find(self.company.id,
+                date=accounting_date)
         return Move(
             origin=self,
-            period=period_id,
-            journal=self._get_accounting_journal(),
+            period=periods[self.company.id],
+            journal=journal,
             date=accounting_date,
             lines=move_lines,
             )
@@ -181,29 +347,35 @@ class SaleLine:
             return True
         return False
 
-    def _get_stock_account_move_lines(self, pending_invoice_account):
+    def _get_stock_account_move_lines(self, pending_invoice_account,
+            stock_moves=None, lines_to_reconcile=None,
+            accounting_date=None, journal=None, uom_rates=None):
         """
         Return the account move lines for shipped quantities and
         to reconcile shipped and invoiced (and posted) quantities
+
+        lines_to_reconcile are the unreconciled lines of the line in the
+        pending invoice account, searched when they are not supplied.
         """
         pool = Pool()
         MoveLine = pool.get('account.move.line')
-        Currency = pool.get('currency.currency')
 
         if (not self.product or self.product.type == 'service' or
                 not self.moves):
             # Sale Line not shipped
             return []
 
-        unposted_shiped_quantity = self._get_unposted_shiped_quantity()
+        unposted_shiped_quantity = self._get_unposted_shiped_quantity(
+            stock_moves=stock_moves, uom_rates=uom_rates)
 
         # Previously created stock account move lines (pending to invoice
         # amount)
-        lines_to_reconcile = MoveLine.search([
-                    ('sale_line', '=', self),
-                    ('account', '=', pending_invoice_account),
-                    ('reconciliation', '=', None),
-                    ])
+        if lines_to_reconcile is None:
+            lines_to_reconcile = MoveLine.search([
+                        ('sale_line', '=', self.id),
+                        ('account', '=', pending_invoice_account.id),
+                        ('reconciliation', '=', None),
+                        ])
 
         move_lines = []
         if not unposted_shiped_quantity and not lines_to_reconcile:
@@ -215,6 +387,14 @@ class SaleLine:
         # sale line unit price => it is reliable
         amount_to_reconcile = sum(l.debit - l.credit
             for l in lines_to_reconcile) if lines_to_reconcile else _ZERO
+
+        invoiced_amount, pending_amount = self._get_stock_account_amounts(
+            amount_to_reconcile, unposted_shiped_quantity, self.unit_price,
+            self.sale.company.currency, self.sale.currency)
+
+        if pending_amount == amount_to_reconcile:
+            return move_lines
+
         if amount_to_reconcile != _ZERO:
             to_reconcile_line = MoveLine()
             to_reconcile_line.account = pending_invoice_account
@@ -229,27 +409,6 @@ class SaleLine:
             to_reconcile_line.reconciliation = None
             move_lines.append(to_reconcile_line)
 
-        pending_amount = Currency.compute(self.sale.company.currency,
-            Decimal(unposted_shiped_quantity) * self.unit_price,
-            self.sale.currency) if unposted_shiped_quantity else _ZERO
-
-        if amount_to_reconcile == _ZERO and unposted_shiped_quantity:
-            # no previous amount in pending invoice account nor pending to
-            # invoice (and post) quantity => first time
-            invoiced_amount = -pending_amount
-        elif not unposted_shiped_quantity:
-            # no pending to invoice and post quantity => invoiced all shiped
-            if amount_to_reconcile > _ZERO:
-                invoiced_amount = amount_to_reconcile
-            else:
-                invoiced_amount = -amount_to_reconcile
-        else:
-            # invoiced partially shiped quantity
-            invoiced_amount = -(amount_to_reconcile + pending_amount)
-
-        if pending_amount == amount_to_reconcile:
-            return []
-
         if invoiced_amount != _ZERO:
             invoiced_line = MoveLine()
             invoiced_line.account = self.product.account_revenue_used
@@ -262,7 +421,8 @@ class SaleLine:
             else:
                 invoiced_line.credit = abs(invoiced_amount)
                 invoiced_line.debit = _ZERO
-            self._set_analytic_lines(invoiced_line)
+            self._set_analytic_lines(invoiced_line,
+                accounting_date=accounting_date, journal=journal)
             move_lines.append(invoiced_line)
 
         if pending_amount != _ZERO:
@@ -281,34 +441,73 @@ class SaleLine:
 
         return move_lines
 
-    def _get_unposted_shiped_quantity(self):
+    @classmethod
+    def _get_stock_account_amounts(cls, amount_to_reconcile,
+            unposted_shiped_quantity, unit_price, from_currency, to_currency):
+        """
+        Return the amount of the revenue line and the new pending amount from
+        the amount pending to reconcile and the shipped quantity which is not
+        invoiced and posted
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        if not unposted_shiped_quantity:
+            pending_amount = _ZERO
+        else:
+            pending_amount = Decimal(unposted_shiped_quantity) * unit_price
+            if from_currency == to_currency:
+                pending_amount = to_currency.round(pending_amount)
+            else:
+                pending_amount = Currency.compute(from_currency,
+                    pending_amount, to_currency)
+
+        # the "to reconcile" line reverses the amount to reconcile and the
+        # pending line adds the pending amount, so the revenue line gets the
+        # difference to balance the move:
+        # - first time (nothing to reconcile): credit the pending amount
+        # - invoiced all shiped (no pending amount): revert the amount to
+        #   reconcile
+        # - invoiced partially shiped quantity: the difference of both
+        invoiced_amount = amount_to_reconcile - pending_amount
+        return invoiced_amount, pending_amount
+
+    def _get_unposted_shiped_quantity(self, stock_moves=None,
+            uom_rates=None):
         """
         Returns the shipped quantity which is not invoiced and posted
+
+        stock_moves is the result of StockMove._read_stock_moves for the line
+        moves, computed when it is not supplied. uom_rates is a dictionary to
+        cache the unit conversion rates.
         """
         pool = Pool()
-        Uom = pool.get('product.uom')
+        StockMove = pool.get('stock.move')
+
+        if stock_moves is None:
+            stock_moves = StockMove._read_stock_moves(self.moves,
+                uom_rates=uom_rates)
 
         sign = -1 if self.quantity < 0.0 else 1
         posted_quantity = 0.0
         sended_quantity = 0.0
-        invoice_quantity = {}
+        invoice_quantity = defaultdict(float)
         for move in self.moves:
-            if move.state != 'done':
+            values = stock_moves[move.id]
+            if values['state'] != 'done':
                 continue
-            sended_quantity += move.quantity
-            for invoice, quantity in move.posted_quantity.iteritems():
-                if invoice not in invoice_quantity:
-                    invoice_quantity[invoice] = quantity
-                else:
-                    invoice_quantity[invoice] += quantity
+            sended_quantity += values['quantity']
+            for invoice, quantity in values['posted_quantity'].items():
+                invoice_quantity[invoice] += quantity
         posted_quantity = sum(invoice_quantity.values())
         # in case split moves, posted quantity is greater than purchase quantity
         if posted_quantity > self.quantity:
             posted_quantity = self.quantity
-        return sign * Uom.compute_qty(move.uom,
-            sended_quantity - posted_quantity, self.unit)
+        return sign * _compute_qty(values['uom'],
+            sended_quantity - posted_quantity, self.unit, rates=uom_rates)
 
-    def _set_analytic_lines(self, move_line):
+    def _set_analytic_lines(self, move_line, accounting_date=None,
+            journal=None):
         """
         Add to supplied account move line analytic lines based on sale line
         analytic accounts value
@@ -321,17 +520,20 @@ class SaleLine:
             return []
 
         AnalyticLine = pool.get('analytic_account.line')
-        analytic_lines = []
-        for entry in self.analytic_accounts:
-            line = AnalyticLine()
-            analytic_lines.append(line)
-
-            line.name = self.description
-            line.debit = move_line.debit
-            line.credit = move_line.credit
-            line.account = entry.account
-            line.journal = self.sale._get_accounting_journal()
-            line.date = Date.today()
-            line.reference = self.sale.reference
-            line.party = self.sale.party
-        move_line.analytic_lines = analytic_lines
+        if accounting_date is None:
+            accounting_date = Date.today()
+        sale = self.sale
+        if journal is None:
+            journal = sale._get_accounting_journal()
+        name, reference, party = self.description, sale.reference, sale.party
+        debit, credit = move_line.debit, move_line.credit
+        move_line.analytic_lines = [AnalyticLine(
+                name=name,
+                debit=debit,
+                credit=credit,
+                account=entry.account,
+                journal=journal,
+                date=accounting_date,
+                reference=reference,
+                party=party,
+                ) for entry in self.analytic_accounts]